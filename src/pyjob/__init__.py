@@ -47,9 +47,9 @@ cleanup from the "jobend" configuration option.
 __author__ = "Owen Embury"
 
 from pyjob.config import config
-from pyjob.job import Job
+from pyjob.job import Job, Task
 
-__all__ = ['config', 'Job', 'use']
+__all__ = ['config', 'Job', 'Task', 'use']
 
 
 def use(platform):
@@ -4,14 +4,36 @@ import cmd
 import re
 import os
 import shlex
+import time
 
 import pyjob
+from pyjob import archive, timing
+from pyjob.core import list2arr
+from pyjob.job import Job, Task
 
 rresub = re.compile(r'_retry(\d+)$')
 
 parse_checklog = argparse.ArgumentParser()
 parse_checklog.add_argument('path', help='Log file directory to scan')
 
+parse_archive = argparse.ArgumentParser(prog='archive', add_help=False)
+parse_archive.add_argument('path', help='Log file directory to archive')
+parse_archive.add_argument('-o', dest='output', help='Archive file name (default path.pjar)')
+parse_archive.add_argument('--remove', action='store_true',
+                           help='Remove the archived log files')
+
+parse_watch = argparse.ArgumentParser(prog='watch', add_help=False)
+parse_watch.add_argument('path', nargs='?', help='Log file directory to watch')
+parse_watch.add_argument('-n', dest='interval', type=float, default=30,
+                         help='Seconds between updates')
+parse_watch.add_argument('-c', dest='count', type=int,
+                         help='Stop after this many updates')
+
+# Results for jobs which have not (yet) finished
+ACTIVE = ('LOST', 'UNKNOWN')
+# Batch system states of jobs which are no longer running
+STOPPED = (None, 'COMPLETED', 'FAILED', 'CANCELLED')
+
 
 def flatten(lst):
     """Flatten a list of lists"""
@@ -42,9 +64,123 @@ def append_retry(path):
         return path + '_retry1'
 
 
+class LogWatcher:
+    """Incremental view of a log directory.
+
+    Each update lists the directory once, parses any new job scripts and only
+    re-reads the logs of unfinished jobs whose size or mtime has changed.
+    Jobs which have finished are never checked again. Unfinished jobs which are
+    no longer running according to the batch system, with no change to their
+    logs over two updates, are also treated as finished (e.g. killed without a
+    message).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.scripts = set()
+        self.jobs = []
+        self.active = {}    # errfile -> (job, log file stats) for unfinished jobs
+        self.missing = set()    # Unfinished jobs no longer running on the batch system
+        self.results = collections.Counter()
+        self.states = collections.Counter()
+        self.history = collections.deque(maxlen=20)
+
+    @staticmethod
+    def stat(name, entries):
+        """Return the (size, mtime) of the log files read by parse_log for the
+        job with stderr name from the directory listing entries"""
+        stats = []
+        for ext in pyjob.cluster.LOGFILES:
+            fname = name[:-4] + ext
+            if fname in entries:
+                st = entries[fname].stat()
+                stats.append((st.st_size, st.st_mtime_ns))
+            else:
+                stats.append(None)
+        return tuple(stats)
+
+    def add(self, job, entries):
+        """Add a newly parsed job. The stat is taken from the listing made before
+        the job was parsed so a later change is always seen as a change."""
+        self.jobs.append(job)
+        self.results[job.result] += 1
+        if job.result in ACTIVE:
+            name = os.path.basename(job.errfile)
+            self.active[name] = (job, self.stat(name, entries))
+
+    def update(self):
+        """Rescan the log directory, returning the number of jobs re-read"""
+        with timing.timer('watch.scandir'):
+            entries = {f.name: f for f in os.scandir(self.path)}
+        for name in entries:
+            if name.endswith('.shell') and name not in self.scripts:
+                self.scripts.add(name)
+                for job in flatten([pyjob.cluster.parse_script(entries[name].path)]):
+                    self.add(job, entries)
+        changed = set()
+        for name, (job, stat) in list(self.active.items()):
+            st = self.stat(name, entries)
+            if st == stat:
+                continue
+            changed.add(name)
+            self.results[job.result] -= 1
+            with timing.timer('parse_log'):
+                pyjob.cluster.parse_log(job.errfile, job)
+            self.results[job.result] += 1
+            if job.result in ACTIVE:
+                self.active[name] = (job, st)
+            else:
+                del self.active[name]
+        self.results += collections.Counter()   # Drop zero counts
+        # Batch system state of all unfinished jobs in a single query
+        jobs = [job for job, _ in self.active.values()]
+        states = pyjob.cluster.status(jobs)
+        if states is not None:
+            missing = {name for name, (job, _) in self.active.items()
+                       if name not in changed
+                       and states.get(job.jobid, states.get(job.id)) in STOPPED}
+            for name in missing & self.missing:
+                del self.active[name]
+            self.missing = missing - self.missing
+        else:
+            states = {}
+        self.states = collections.Counter(
+            states.get(j.jobid, states.get(j.id, j.result)) for j, _ in self.active.values())
+        self.history.append((time.time(), len(self.jobs) - len(self.active)))
+        return len(changed)
+
+    def rate(self):
+        """Return the number of jobs finishing per minute"""
+        t0, n0 = self.history[0]
+        t1, n1 = self.history[-1]
+        return 60 * (n1 - n0) / (t1 - t0) if t1 > t0 else 0
+
+    def summary(self):
+        lines = [time.strftime('%H:%M:%S') + f' {self.path}']
+        lines.append(f"{self.results['DONE']:6d} DONE")
+        # Finished jobs, including those which stopped without recording a result
+        finished = self.results - collections.Counter(j.result for j, _ in self.active.values())
+        for r in sorted(finished):
+            if r != 'DONE':
+                lines.append(f"{finished[r]:6d} {r}")
+        for s in sorted(self.states):
+            lines.append(f"{self.states[s]:6d} {s}")
+        rate = self.rate()
+        if rate > 0:
+            eta = len(self.active) / rate
+            lines.append(f'{rate:.1f} jobs/min, ETA {int(eta//60)}h{int(eta % 60):02d}m')
+        return '\n'.join(lines)
+
+
 class PyjobShell(cmd.Cmd):
     intro = 'pyjob interactive shell. Type help or ? to list commands\n'
     prompt = 'pyjob>>> '
+    archive = None
+
+    def onecmd(self, line):
+        name = line.split(maxsplit=1)[0] if line.strip() else ''
+        with timing.timer('shell.' + name):
+            return super().onecmd(line)
 
     def do_exit(self, arg):
         """Quit"""
@@ -60,6 +196,14 @@ class PyjobShell(cmd.Cmd):
             else:
                 print('Usage: checklog log_path')
                 return
+        elif archive.archive_path(arg):
+            try:
+                self.archive = archive.Archive(archive.archive_path(arg))
+            except ValueError as err:
+                print(err)
+                return
+            jobs = self.archive.jobs(pyjob.cluster)
+            self.logpath = self.archive.logpath
         else:
             try:
                 files = os.scandir(arg)
@@ -76,6 +220,8 @@ class PyjobShell(cmd.Cmd):
             # Array jobs will be returned a list, so flatten possible list-of-lists
             jobs = list(flatten(pyjob.cluster.parse_script(f) for f in files))
             self.logpath = arg
+            self.archive = None
+        if arg:
             self.jobs_done = [j for j in jobs if j.done]
             self.jobs_fail = [j for j in jobs if not j.done]
             self.results = collections.Counter([j.result for j in self.jobs_fail])
@@ -94,6 +240,42 @@ class PyjobShell(cmd.Cmd):
             path = ''
         return listdirs(path, text)
 
+    def do_watch(self, arg):
+        """Show job progress until interrupted: watch [path] [-n seconds] [-c count]"""
+        try:
+            args = parse_watch.parse_args(shlex.split(arg))
+        except SystemExit:
+            return
+        path = args.path or getattr(self, 'logpath', None)
+        if not path:
+            print('Usage: watch log_path')
+            return
+        if not os.path.isdir(path):
+            print(f'Not a directory: {path}')
+            return
+        watcher = LogWatcher(path)
+        count = 0
+        try:
+            while True:
+                watcher.update()
+                print(watcher.summary())
+                count += 1
+                if not watcher.active or count == args.count:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            print()
+        # Leave the latest results loaded for the other commands
+        if path != getattr(self, 'logpath', None):
+            self.jobopts = {}
+        self.logpath = path
+        self.archive = None
+        self.jobs_done = [j for j in watcher.jobs if j.done]
+        self.jobs_fail = [j for j in watcher.jobs if not j.done]
+        self.results = collections.Counter([j.result for j in self.jobs_fail])
+
+    complete_watch = complete_checklog
+
     def no_log_loaded(self):
         if not hasattr(self, 'results'):
             print('ERROR - load a log directory with checklog first')
@@ -152,12 +334,86 @@ class PyjobShell(cmd.Cmd):
             jobs = [j for j in self.jobs_done if j.jobid == jid]
         if jobs:
             j = jobs[0]
+            if self.archive is not None:
+                # Only take the job messages from the archived stderr, the result
+                # and batch system messages were saved when archiving
+                log = Job([])
+                pyjob.cluster.parse_stderr(self.archive.read_log(j.errfile), log)
+                j.stderr = log.stderr
+                j.steps = log.steps
             print(j)
+            if j.steps:
+                print('commands:')
+                for i, status, seconds in j.steps:
+                    print(f'{i:6d} status {status} time {seconds:.2f}s : {j.command[i]}')
             print('job stderr:\n' + ''.join(j.stderr))
             print('batch system:\n' + ''.join(j.baterr))
         else:
             print(f'No such job: {jid}')
 
+    def do_archive(self, arg):
+        """Pack a log directory into a single file: archive path [-o file] [--remove]"""
+        try:
+            args = parse_archive.parse_args(shlex.split(arg))
+        except SystemExit:
+            return
+        if not os.path.isdir(args.path):
+            print(f'Not a directory: {args.path}')
+            return
+        filename, files = archive.create(pyjob.cluster, args.path, args.output)
+        ntasks = len(archive.Archive(filename).tasks)
+        print(f'Archived {ntasks} jobs ({len(files)} files) to {filename}')
+        if args.remove:
+            for f in files:
+                os.remove(f)
+            if not os.listdir(args.path):
+                os.rmdir(args.path)
+
+    complete_archive = complete_checklog
+
+    def select_jobs(self, arg, default=None):
+        """Return incomplete jobs matching the result codes in arg, or those
+        matching default (all incomplete jobs if None) when arg is empty"""
+        toshow = shlex.split(arg) or default
+        if not toshow:
+            return self.jobs_fail
+        jobs = [j for j in self.jobs_fail if j.result in toshow]
+        if 'DONE' in toshow:
+            jobs += self.jobs_done
+        return jobs
+
+    def do_cancel(self, arg):
+        """Cancel jobs on the cluster: cancel [result ...]
+
+        By default only jobs which may still be queued or running are cancelled."""
+        if self.no_log_loaded():
+            return
+        jobs = self.select_jobs(arg, default=list(ACTIVE))
+        if not jobs:
+            print('No jobs to cancel')
+            return
+        try:
+            failed = pyjob.cluster.cancel(jobs)
+        except NotImplementedError as err:
+            print(f'Cannot cancel jobs: {err}')
+            return
+        print(f'Cancelled {len(jobs)} jobs' + (f' ({failed} calls failed)' if failed else ''))
+
+    def do_requeue(self, arg):
+        """Requeue jobs on the cluster: requeue [result ...]"""
+        if self.no_log_loaded():
+            return
+        jobs = self.select_jobs(arg)
+        if not jobs:
+            print('No jobs to requeue')
+            return
+        try:
+            failed = pyjob.cluster.requeue(jobs)
+        except NotImplementedError as err:
+            print(f'Cannot requeue jobs: {err}')
+            return
+        print(f'Requeued {len(jobs)} jobs' + (f' ({failed} calls failed)' if failed else ''))
+
     def do_setopt(self, arg):
         """Override a job option when resubmitting"""
         opts = arg.split(maxsplit=1)
@@ -172,19 +428,40 @@ class PyjobShell(cmd.Cmd):
 
     def do_resub(self, arg):
         """Resubmit failed jobs to cluster system"""
+        if self.no_log_loaded():
+            return
         logpath = append_retry(self.logpath)
         print(f'Creating outputdir {logpath}')
         os.makedirs(logpath, exist_ok=True)
+        opts = dict(self.jobopts, logpath=logpath)
+        # Failed array tasks are resubmitted as a single array job
+        arrays = collections.defaultdict(list)
         for j in self.jobs_fail:
-            j.options.update(self.jobopts)
-            if 'array' in j.options:
-                j.options['array'] = j.ind
-            j.options['logpath'] = logpath
-            pyjob.cluster.submit(j)
+            if isinstance(j, Task):
+                arrays[j.job].append(j.ind)
+            else:
+                pyjob.cluster.submit(j.clone(**opts))
+        for job, inds in arrays.items():
+            pyjob.cluster.submit(job.clone(**dict(opts, array=list2arr(inds))))
 
 
-def main():
-    PyjobShell().cmdloop()
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyjob', description='pyjob interactive shell')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print timing statistics at exit')
+    parser.add_argument('--profile-file', metavar='FILE',
+                        help='Write timing statistics at exit to FILE as JSON')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='Run a single shell command, e.g. pyjob archive PATH')
+    args = parser.parse_args(argv)
+    if args.profile_file:
+        timing.enable(args.profile_file)
+    elif args.profile:
+        timing.enable('-')
+    if args.command:
+        PyjobShell().onecmd(' '.join(shlex.quote(a) for a in args.command))
+    else:
+        PyjobShell().cmdloop()
 
 
 if __name__ == "__main__":
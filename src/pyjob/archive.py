@@ -0,0 +1,144 @@
+"""
+Single file archives of pyjob log directories
+
+A finished log directory holds three files per task (.shell, .out and .err).
+An archive packs these into one file with a compact index so the job results
+can be read with a single open, and any one task's logs read without
+decompressing the rest. The layout is:
+
+    PYJOBAR1                    magic
+    offset                      8 byte little-endian offset of the index
+    blobs                       zlib compressed .shell/.out/.err file contents
+    index                       zlib compressed JSON
+
+The index holds a list of [name, offset, length] for each .shell file and a
+table with one row per task of:
+
+    script, ind, name, done, result, host, out offset, out length, err offset,
+    err length, baterr
+
+where script is the position of the task's .shell in the script list, ind is
+the array index (or null), name is the log file name without extension and
+baterr the batch system messages found when the logs were parsed (which for
+some batch systems come from the .out as well as the .err). Offsets are null
+for files which did not exist.
+"""
+import json
+import os
+import struct
+import zlib
+
+from pyjob.job import Job, Task
+
+MAGIC = b'PYJOBAR1'
+ARCHIVE_EXT = '.pjar'
+
+
+def archive_path(path):
+    """Return the archive for path if it is (or has been replaced by) an archive"""
+    if os.path.isfile(path):
+        return path
+    path = path.rstrip('/') + ARCHIVE_EXT
+    if not os.path.isdir(path[:-len(ARCHIVE_EXT)]) and os.path.isfile(path):
+        return path
+    return None
+
+
+def create(cluster, path, filename=None):
+    """Pack the log directory path into an archive.
+
+    Returns the archive filename and a list of the files archived. The log
+    files themselves are not removed."""
+    if filename is None:
+        filename = path.rstrip('/') + ARCHIVE_EXT
+    files = sorted(f.path for f in os.scandir(path) if f.name.endswith('.shell'))
+    archived = []
+    scripts = []
+    tasks = []
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as fh:
+        fh.write(MAGIC + struct.pack('<Q', 0))
+
+        def blob(fname):
+            try:
+                with open(fname, 'rb') as src:
+                    data = src.read()
+            except FileNotFoundError:
+                return [None, None]
+            archived.append(fname)
+            offset = fh.tell()
+            fh.write(zlib.compress(data))
+            return [offset, fh.tell() - offset]
+
+        for i, script in enumerate(files):
+            scripts.append([os.path.basename(script)[:-6]] + blob(script))
+            jobs = cluster.parse_script(script)
+            for job in (jobs if isinstance(jobs, list) else [jobs]):
+                base = job.errfile[:-4]
+                tasks.append([i, getattr(job, 'ind', None), os.path.basename(base),
+                              job.done, job.result, job.host]
+                             + blob(base + '.out') + blob(base + '.err')
+                             + [job.baterr])
+        offset = fh.tell()
+        index = {'scripts': scripts, 'tasks': tasks}
+        fh.write(zlib.compress(json.dumps(index, separators=(',', ':')).encode()))
+        fh.seek(len(MAGIC))
+        fh.write(struct.pack('<Q', offset))
+    os.replace(tmpname, filename)
+    return filename, archived
+
+
+class Archive:
+    """Read access to a pyjob log archive"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'Not a pyjob archive: {filename}')
+            offset, = struct.unpack('<Q', fh.read(8))
+            fh.seek(offset)
+            index = json.loads(zlib.decompress(fh.read()))
+            self.tasks = index['tasks']
+            self.scripts = []
+            for name, offset, length in index['scripts']:
+                fh.seek(offset)
+                self.scripts.append((name, zlib.decompress(fh.read(length)).decode()))
+        self.logs = {row[2]: row[6:10] for row in self.tasks}
+
+    @property
+    def logpath(self):
+        """The log directory this archive was created from"""
+        return self.filename[:-len(ARCHIVE_EXT)] if self.filename.endswith(ARCHIVE_EXT) \
+            else self.filename
+
+    def jobs(self, cluster):
+        """Return the archived jobs with their results and batch system messages
+        but without stderr, which can be read when required with read_log."""
+        parents = []
+        for name, text in self.scripts:
+            job = Job.fromstring([line.strip() for line in text.splitlines()],
+                                 cluster.CMDPRE)
+            cluster.decode_job(job, name)
+            parents.append(job)
+        jobs = []
+        for script, ind, name, done, result, host, *_, baterr in self.tasks:
+            job = parents[script] if ind is None else Task(parents[script], ind)
+            job.errfile = os.path.join(self.filename, name + '.err')
+            job.done = done
+            job.result = result
+            job.host = host
+            job.baterr = baterr
+            jobs.append(job)
+        return jobs
+
+    def read_log(self, logfile):
+        """Return the lines of an archived .out or .err file"""
+        name, ext = os.path.splitext(os.path.basename(logfile))
+        offsets = self.logs[name]
+        offset, length = offsets[:2] if ext == '.out' else offsets[2:]
+        if offset is None:
+            return []
+        with open(self.filename, 'rb') as fh:
+            fh.seek(offset)
+            return zlib.decompress(fh.read(length)).decode().splitlines(keepends=True)
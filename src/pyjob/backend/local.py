@@ -1,14 +1,99 @@
 """
 Dummy backend for running jobs locally via subprocess.run
+
+Array jobs are run on a pool of worker threads. Each worker repeatedly takes
+the next chunk of array indices and runs them from a single shell loop, so many
+short tasks do not each pay the cost of starting a process from Python. Chunks
+shrink as the remaining work runs out (guided self-scheduling) so idle workers
+pick up the tail of the array rather than waiting on one large chunk.
 """
+import os
+import shlex
 import subprocess
-from pyjob.core import NoBatchSystem
+import threading
+import time
+
+from pyjob.core import NoBatchSystem, arr2list, str2arr
+
+
+class ArrayScheduler:
+    """Hand out chunks of array indices to workers"""
+
+    def __init__(self, indices, workers, maxchunk=64):
+        self.indices = indices
+        self.workers = workers
+        self.maxchunk = maxchunk
+        self.pos = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        """Return the next chunk of indices, or an empty list when done"""
+        with self.lock:
+            remaining = len(self.indices) - self.pos
+            n = max(1, min(self.maxchunk, remaining // (2 * self.workers)))
+            chunk = self.indices[self.pos:self.pos+n]
+            self.pos += len(chunk)
+            return chunk
 
 
 class BatchSystem(NoBatchSystem):
     """Run jobs locally"""
 
-    def submit(self, job, dryrun=False):
+    def submit(self, job, dryrun=False, skip_completed=None):
+        job = self.prepare(job, skip_completed)
+        if job is None:
+            return
+        if 'array' in job.options:
+            return self.submit_array(job, dryrun)
         if isinstance(job.command, list) and len(job.command) > 1:
             raise Exception('non trivial jobs not supported by local backend')
         subprocess.run(job.command, shell=True)
+
+    def submit_array(self, job, dryrun=False):
+        """Run all indices of an array job, returning once they have completed.
+
+        Each index writes its own .out / .err file and the job script is saved
+        as .shell so the logs can be read with parse_script like any other
+        backend. The number of workers defaults to the number of CPUs and can be
+        set with the "workers" option."""
+        script = self.write_script(job)
+        logname = job.stdoutname
+        if '{ind}' not in logname:
+            # Every index would write the same .out / .err files
+            raise ValueError(f'logname for array jobs must include {{ind}}: {logname}')
+        if dryrun:
+            print(script)
+            return
+        jobid = str(int(time.time() * 1e6))
+        logdir = os.path.dirname(logname)
+        if logdir:
+            os.makedirs(logdir, exist_ok=True)
+        fname = logname.format(jobid=jobid, ind='arr') + '.shell'
+        with open(fname, 'w') as fh:
+            fh.write(script)
+
+        interp = job.shebang[2:].split()[-1]
+        pre, post = logname.format(jobid=jobid, ind='\0').split('\0')
+        log = shlex.quote(pre) + '"$JOBINDEX"' + shlex.quote(post)
+        run = f'{interp} {shlex.quote(fname)} >{log}.out 2>{log}.err'
+
+        arrdef = job.options['array']
+        if isinstance(arrdef, str):
+            arrdef = str2arr(arrdef)
+        indices = arr2list(arrdef)
+        workers = int(job.options.get('workers', 0)) or os.cpu_count() or 1
+        workers = min(workers, len(indices))
+        scheduler = ArrayScheduler(indices, workers)
+
+        def worker():
+            for chunk in iter(scheduler.next, []):
+                loop = ' '.join(str(i) for i in chunk)
+                subprocess.run(['/bin/sh', '-c', f'for JOBINDEX in {loop}; do export JOBINDEX; {run}; done'],
+                               env=dict(os.environ, JOBID=jobid))
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return jobid
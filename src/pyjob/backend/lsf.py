@@ -1,10 +1,75 @@
 """
 Backend for using IBM Platform Load Sharing Facility (LSF)
 
-NOTE - this has not been maintained since Jasmin migrated to Slurm
+LSF writes its job report (including any TERM_ reason for the job being killed)
+to the job stdout, so both the .out and .err files are read when checking logs.
 """
 import re
-from pyjob.core import BatchSystemBase
+import subprocess
+from pyjob import timing
+from pyjob.core import BatchSystemBase, str2arr, arr2str
+
+rjobname = re.compile(r'^(?P<name>.*?)(?:\[(?P<array>[^\]]*)\])?$')
+rterm = re.compile(r'^(TERM_\w+):')
+term2map = {
+    'TERM_MEMLIMIT': 'OOMEMORY',
+    'TERM_SWAP': 'OOMEMORY',
+    'TERM_RUNLIMIT': 'TIMEOUT',
+    'TERM_CPULIMIT': 'TIMEOUT',
+    'TERM_OWNER': 'KILLED',
+    'TERM_FORCE_OWNER': 'KILLED',
+    'TERM_ADMIN': 'KILLED',
+    'TERM_FORCE_ADMIN': 'KILLED',
+    'TERM_REQUEUE_OWNER': 'KILLED',
+    'TERM_REQUEUE_ADMIN': 'KILLED',
+    'TERM_HOST': 'NODEFAIL',
+    'TERM_UNKNOWN': 'NODEFAIL',
+    }
+stat2map = {
+    'PEND': 'PENDING',
+    'RUN': 'RUNNING',
+    'PSUSP': 'SUSPENDED',
+    'USUSP': 'SUSPENDED',
+    'SSUSP': 'SUSPENDED',
+    'DONE': 'COMPLETED',
+    'EXIT': 'FAILED',
+    }
+
+
+def read_report(fname, tail=65536):
+    """Return the TERM_ reason and exit code lines of the LSF job report in a
+    job output file.
+
+    The report is either at the start of the file, ending "The output (if any)
+    follows", or (when written with -o) appended after the job output, ending
+    "The output (if any) is above this job summary". In the first case the file
+    is only read up to the end of the report and in the second only the last
+    tail bytes are read."""
+    try:
+        with open(fname, 'rb') as fh:
+            first = fh.readline()
+            if first.startswith(b'Sender: LSF System'):
+                lines = [first]
+                for line in fh:
+                    if line.startswith(b'The output (if any)'):
+                        break
+                    lines.append(line)
+            else:
+                size = fh.seek(0, 2)
+                fh.seek(max(0, size - tail))
+                lines = fh.read().splitlines(keepends=True)
+                start = [i for i, line in enumerate(lines) if line.startswith(b'Sender: LSF System')]
+                lines = lines[start[-1]:] if start else []
+    except FileNotFoundError:
+        return []
+    report = []
+    for line in lines:
+        line = line.decode(errors='replace')
+        if line.startswith('The output (if any)'):
+            break
+        if rterm.match(line) or line.startswith('Exited with exit code'):
+            report.append(line)
+    return report
 
 
 class BatchSystem(BatchSystemBase):
@@ -16,13 +81,25 @@ class BatchSystem(BatchSystemBase):
               'JOBINDEX': 'LSB_JOBINDEX'}
     SUBMIT_CMD = 'bsub'
     SUBMIT_OUT = re.compile(r'^Job\s<(?P<id>\d+)>')
+    SUBMIT_LIMIT = re.compile(r'job limit|job threshold')
+    SUBMIT_RETRY = re.compile(r'LSF is down|not responding|Failed in an LSF library call|timed out')
+    ARRAY_FMT = '{id}[{ind}]'
+    LOGFILES = ('.err', '.out')
+    CANCEL_CMD = 'bkill'
+    REQUEUE_CMD = 'brequeue'
 
     def encode_options(self, options):
         hdr = []
-        if 'name' in options:
+        if 'array' in options:
+            # LSF defines job arrays via the job name
+            hdr.append('-J {}[{}]'.format(options.get('name', 'job'),
+                                          arr2str(options['array'])))
+        elif 'name' in options:
             hdr.append('-J {}'.format(options['name']))
         if 'queue' in options:
             hdr.append('-q {}'.format(options['queue']))
+        if 'account' in options:
+            hdr.append('-P {}'.format(options['account']))
         if 'runtime' in options:
             hdr.append('-W {}'.format(options['runtime']))
         if 'logname' in options:
@@ -40,5 +117,82 @@ class BatchSystem(BatchSystemBase):
         return [self.PREFIX + ' ' + line for line in hdr]
 
     def decode_options(self, hdr):
-        raise Exception('Not implemented')
-        return {}
+        opts = {}
+        for line in hdr:
+            flag, _, value = line[len(self.PREFIX)+1:].partition(' ')
+            if flag == '-J':
+                m = rjobname.match(value)
+                opts['name'] = m.group('name')
+                if m.group('array'):
+                    opts['array'] = str2arr(m.group('array'))
+            elif flag == '-q':
+                opts['queue'] = value
+            elif flag == '-P':
+                opts['account'] = value
+            elif flag == '-W':
+                opts['runtime'] = value
+            elif flag == '-o':
+                opts['logname'] = value[:-4].replace('%J', '{jobid}').replace('%I', '{ind}')
+            elif flag == '-M':
+                opts['memlimit'] = value
+            elif flag == '-R' and value.startswith('rusage[tmp='):
+                opts['tmplimit'] = value[11:-1]
+            elif flag == '-R' and value.startswith('"select['):
+                hosts = value[8:-2].split(' && ')
+                opts['exclude'] = ' '.join(h[len('hname!='):] for h in hosts)
+        return opts
+
+    def parse_log(self, script, job):
+        if script.endswith('.shell'):
+            stderr = script[:-6] + '.err'
+        else:
+            stderr = script
+        report = read_report(stderr[:-4] + '.out')
+        try:
+            with open(stderr) as fh:
+                lines = fh.readlines()
+        except FileNotFoundError:
+            if not report:
+                job.done = False
+                job.result = 'LOST'
+                return
+            lines = []
+        self.parse_stderr(report + lines, job)
+
+    def parse_stderr(self, lines, job):
+        # Separate the LSF job report from job messages
+        report = []
+        other = []
+        for line in lines:
+            if rterm.match(line) or line.startswith('Exited with exit code'):
+                report.append(line)
+            else:
+                other.append(line)
+        super().parse_stderr(other, job)
+        job.baterr = report
+        for line in report:
+            m = rterm.match(line)
+            if m:
+                job.done = False
+                job.result = term2map.get(m.group(1), 'BATCHERR')
+                break
+            elif job.result == 'UNKNOWN':
+                # Killed before the pyjob epilog could record the status
+                job.result = 'ERROR'
+
+    def status(self, jobs):
+        ids = sorted({j.id for j in jobs if j.id is not None})
+        if not ids:
+            return {}
+        with timing.timer('status.bjobs'):
+            bjobs = subprocess.run(['bjobs', '-a', '-noheader', '-o', 'jobid jobindex stat'] + ids,
+                                   capture_output=True, text=True)
+        states = {}
+        for line in bjobs.stdout.splitlines():
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            jid, ind, stat = fields
+            jid = jid if ind == '0' else f'{jid}-{ind}'
+            states[jid] = stat2map.get(stat, stat)
+        return states
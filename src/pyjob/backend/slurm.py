@@ -2,6 +2,8 @@
 Backend for using Slurm Workload Manager
 """
 import re
+import subprocess
+from pyjob import timing
 from pyjob.core import BatchSystemBase, trap_run, str2arr, arr2str
 
 rcancel = re.compile(r'slurmstepd:.*JOB (\d+) ON (\w+) CANCELLED.*DUE TO ([\w\s]+)')
@@ -19,6 +21,11 @@ class BatchSystem(BatchSystemBase):
               'JOBINDEX': 'SLURM_ARRAY_TASK_ID'}
     SUBMIT_CMD = 'sbatch'
     SUBMIT_OUT = re.compile(r'^Submitted\sbatch\sjob\s(?P<id>\d+)')
+    SUBMIT_LIMIT = re.compile(r'MaxSubmitJob|MaxJobCount|job count limit')
+    SUBMIT_RETRY = re.compile(r'Socket timed out|Unable to contact slurm controller|'
+                              r'temporarily unavailable|temporarily unable|Zero Bytes were transmitted')
+    CANCEL_CMD = 'scancel'
+    REQUEUE_CMD = 'scontrol requeue'
     JOBSETUP = trap_run.splitlines()
     CMDPRE = 'run'
 
@@ -84,26 +91,32 @@ class BatchSystem(BatchSystemBase):
 
         return opts
 
-    def parse_log(self, script, job):
-        if script.endswith('.shell'):
-            stderr = script[:-6] + '.err'
-        else:
-            stderr = script
-        try:
-            with open(stderr) as fh:
-                lines = fh.readlines()
-        except FileNotFoundError:
-            job.done = False
-            job.result = 'LOST'
-            return
+    def requeue(self, jobs):
+        # scontrol takes a single comma separated job list
+        return self._control(self.REQUEUE_CMD, jobs, sep=',')
+
+    def status(self, jobs):
+        ids = sorted({j.id for j in jobs if j.id is not None})
+        if not ids:
+            return {}
+        # A single squeue call for all jobs, with array tasks listed one per line
+        with timing.timer('status.squeue'):
+            squeue = subprocess.run(['squeue', '-h', '-r', '-o', '%i %T', '-j', ','.join(ids)],
+                                    capture_output=True, text=True)
+        states = {}
+        for line in squeue.stdout.splitlines():
+            jid, _, state = line.partition(' ')
+            states[jid.replace('_', '-')] = state.strip()
+        return states
 
+    def parse_stderr(self, lines, job):
         # Separate stderr into Slurm and job messages
         job.stderr = []
         job.baterr = []
+        job.steps = []
         for line in lines:
             if line.startswith('pyjob:'):
-                host = line.partition('host:')[2].split()
-                job.host = host[0] if host else ''
+                self.parse_pyjob(line, job)
             elif line.startswith('cpu-bind=MASK'):
                 job.host = line[16:line.index(',')]
             elif line.startswith('srun:') or line.startswith('slurmstepd:'):
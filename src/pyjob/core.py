@@ -1,17 +1,21 @@
-import copy
+import collections
+import concurrent.futures
 import itertools
 import logging
 import os
 import re
 import subprocess
+import sys
 
+from pyjob import archive, timing
 from pyjob.config import config
-from pyjob.job import Job
+from pyjob.job import Job, Task
 
 _log = logging.getLogger(__name__)
 
 _rarray = re.compile(r'(\d+)-(\d+)(?::(\d+))?')
 _rformat = re.compile(r"({\w*})")
+_rstep = re.compile(r'pyjob: task (\d+) status (\d+) time ([\d.]+)')
 
 
 trap_run = """run()
@@ -62,6 +66,25 @@ def arr2list(arrdef):
         return [arrdef]
 
 
+def list2arr(indices):
+    """Compress a list of array indices to a list of range and int objects.
+
+    Consecutive indices are merged into ranges so the result can be passed to
+    arr2str to give the shortest job array definition, e.g. [1, 2, 3, 5] gives
+    [range(1, 4), 5] -> "1-3,5"."""
+    arrdef = []
+    indices = sorted(set(indices))
+    i0 = 0
+    for i in range(1, len(indices)+1):
+        if i == len(indices) or indices[i] != indices[i-1] + 1:
+            if i - i0 > 1:
+                arrdef.append(range(indices[i0], indices[i-1]+1))
+            else:
+                arrdef.append(indices[i0])
+            i0 = i
+    return arrdef
+
+
 def fmt2re(fmt):
     """Convert a format pattern to the inverse regular expression"""
     def ptransform(part):
@@ -74,11 +97,35 @@ def fmt2re(fmt):
     return re.compile(''.join([ptransform(p) for p in _rformat.split(fmt)]))
 
 
+class SubmitError(Exception):
+    """Job submission was rejected by the batch system.
+
+    reason is 'limit' if a submission limit was reached, 'retry' for transient
+    errors (e.g. controller timeouts) or None otherwise."""
+
+    def __init__(self, cmd, proc, script, reason=None):
+        msg = (proc.stderr or proc.stdout).strip()
+        super().__init__(f'{cmd} failed ({proc.returncode}): {msg}')
+        self.returncode = proc.returncode
+        self.stdout = proc.stdout
+        self.stderr = proc.stderr
+        self.script = script
+        self.reason = reason
+
+
 class BatchSystemBase:
     """Base class for workload managers"""
     JOBSETUP = []
     JOBEND = []
     CMDPRE = ''
+    SUBMIT_LIMIT = None     # Regex matching submit errors due to job limits
+    SUBMIT_RETRY = None     # Regex matching transient submit errors
+    LOGFILES = ('.err',)    # Log files read by parse_log
+    ARRAY_FMT = '{id}_[{ind}]'
+    CANCEL_CMD = None
+    REQUEUE_CMD = None
+    MAX_IDS = 500       # Job ids per cancel / requeue call
+    MAX_CALLS = 4       # Concurrent cancel / requeue calls
 
     def __init__(self):
         # Make sure we have a valid config section. An empty section
@@ -86,8 +133,11 @@ class BatchSystemBase:
         if self.platform not in config:
             config[self.platform] = {}
 
+    @timing.timed('write_script')
     def write_script(self, job):
         """Submit a job to the Batch System"""
+        if isinstance(job, Task):
+            job = job.clone()
         cfg = config[self.platform]
         opts = dict(cfg)
         opts.update(job.options)
@@ -115,10 +165,84 @@ class BatchSystemBase:
                    'exit $status',
                    '']
 
-        return job.write(self.CMDPRE, prolog, epilog)
+        # Optionally run the commands in parallel with pyjob.runner
+        runner = None
+        if opts.get('parallel'):
+            runner = opts.get('python', sys.executable) + ' -m pyjob.runner -f /dev/fd/3'
+            if opts['parallel'] != 'all':
+                runner += ' -j {}'.format(opts['parallel'])
+            if job.env:
+                runner += ' -s {}'.format(job.env)
+            # Each command runs in its own shell, so export anything the script
+            # section defines (bash also exports functions)
+            prolog += ['set -a']
 
-    def submit(self, job, dryrun=False):
-        """Submit a job to the Batch System"""
+        return job.write(self.CMDPRE, prolog, epilog, runner)
+
+    def completed(self, paths):
+        """Return the digests of all completed jobs in the log directories (or
+        archives) paths.
+
+        The result can be passed as skip_completed to submit. Build it once and
+        reuse it when submitting many jobs."""
+        if isinstance(paths, str):
+            paths = [paths]
+        done = set()
+        for path in paths:
+            if archive.archive_path(path):
+                jobs = archive.Archive(archive.archive_path(path)).jobs(self)
+                done.update(job.digest() for job in jobs if job.done)
+                continue
+            try:
+                files = [f.path for f in os.scandir(path) if f.name.endswith('.shell')]
+            except FileNotFoundError:
+                continue
+            for f in files:
+                jobs = self.parse_script(f)
+                for job in (jobs if isinstance(jobs, list) else [jobs]):
+                    if job.done:
+                        done.add(job.digest())
+        return done
+
+    def remaining(self, job, completed):
+        """Return job with any work listed in completed removed, or None if
+        there is nothing left to run. Array jobs are returned as a copy with
+        only the outstanding indices."""
+        if 'array' not in job.options:
+            return None if job.digest() in completed else job
+        arrdef = job.options['array']
+        if isinstance(arrdef, str):
+            arrdef = str2arr(arrdef)
+        allind = arr2list(arrdef)
+        todo = [i for i in allind if job.digest(i) not in completed]
+        if not todo:
+            return None
+        elif len(todo) == len(allind):
+            return job
+        return job.clone(array=list2arr(todo))
+
+    def prepare(self, job, skip_completed=None):
+        """Return the job to submit, or None if there is nothing to submit.
+
+        Array tasks are submitted as a job running only that index and any
+        work in skip_completed is removed (see remaining)."""
+        if isinstance(job, Task):
+            job = job.clone()
+        if skip_completed is not None:
+            job = self.remaining(job, skip_completed)
+            if job is None:
+                _log.info('Skipping completed job')
+        return job
+
+    @timing.timed('submit')
+    def submit(self, job, dryrun=False, skip_completed=None):
+        """Submit a job to the Batch System
+
+        If skip_completed is given (see completed) then work which has already
+        completed is not resubmitted. Returns None if nothing was submitted."""
+        job = self.prepare(job, skip_completed)
+        if job is None:
+            return
         script = self.write_script(job)
         if dryrun:
             print(script)
@@ -129,8 +253,9 @@ class BatchSystemBase:
         if logdir:
             os.makedirs(logdir, exist_ok=True)
         # And submit to cluster system
-        bsub = subprocess.run(self.SUBMIT_CMD, input=script, capture_output=True,
-                              text=True)
+        with timing.timer('submit.' + self.SUBMIT_CMD):
+            bsub = subprocess.run(self.SUBMIT_CMD, input=script, capture_output=True,
+                                  text=True)
         match = self.SUBMIT_OUT.match(bsub.stdout)
         if bsub.returncode == 0 and match:
             jobid = match.group('id')
@@ -139,42 +264,162 @@ class BatchSystemBase:
                 fh.write(script)
             return jobid
         else:
-            print(script)
-            print(bsub.stdout)
-            print(bsub.stderr)
-            raise Exception
+            if self.SUBMIT_LIMIT and self.SUBMIT_LIMIT.search(bsub.stderr):
+                reason = 'limit'
+            elif self.SUBMIT_RETRY and self.SUBMIT_RETRY.search(bsub.stderr):
+                reason = 'retry'
+            else:
+                reason = None
+            raise SubmitError(self.SUBMIT_CMD, bsub, script, reason)
 
-    def parse_script(self, script):
-        job = Job.fromfile(script, self.CMDPRE)
-        job.host = ''
-        hdr = [line for line in job.prolog if line.startswith(self.PREFIX)]
-        job.options = self.decode_options(hdr)
-        # Split log into path and name
-        path, name = os.path.split(job.options['logname'])
-        job.options['logpath'] = path
-        job.options['logname'] = name
+    def encode_jobids(self, jobs):
+        """Return the shortest list of batch system job ids for jobs.
 
-        rname = fmt2re(name)
-        m = rname.match(os.path.basename(script)[:-6])
-        if m:
-            job.id = m.group('jobid')
-        else:
-            job.id = os.path.basename(script)[:-6]
+        Array tasks from the same job are merged using ARRAY_FMT so cancelling
+        an entire array needs a single id, e.g. 1234_[1-100,200]. Jobs which
+        were never submitted are ignored."""
+        ids = []
+        tasks = collections.defaultdict(list)
+        for job in jobs:
+            if getattr(job, 'id', None) is None:
+                continue
+            if hasattr(job, 'ind'):
+                tasks[job.id].append(job.ind)
+            elif job.id not in ids:
+                ids.append(job.id)
+        for jid, inds in tasks.items():
+            if jid not in ids:
+                ids.append(self.ARRAY_FMT.format(id=jid, ind=arr2str(list2arr(inds))))
+        return ids
+
+    def _control(self, cmd, jobs, sep=None):
+        """Run a batch system command on jobs returning the number of failed calls.
+
+        Job ids are passed as separate arguments, or joined with sep if the
+        command expects a single job list. Raises NotImplementedError if the
+        batch system has no such command."""
+        if not cmd:
+            raise NotImplementedError(f'Not supported by the {self.platform} batch system')
+        ids = self.encode_jobids(jobs)
+        chunks = [ids[i:i+self.MAX_IDS] for i in range(0, len(ids), self.MAX_IDS)]
+
+        def run(chunk):
+            args = [sep.join(chunk)] if sep else chunk
+            return subprocess.run(cmd.split() + args, capture_output=True, text=True)
+
+        failed = 0
+        timing.count(cmd, len(chunks))
+        with concurrent.futures.ThreadPoolExecutor(self.MAX_CALLS) as pool:
+            for proc in pool.map(run, chunks):
+                if proc.returncode != 0:
+                    failed += 1
+                    _log.warning('%s failed: %s', cmd, proc.stderr.strip())
+        return failed
+
+    def cancel(self, jobs):
+        """Cancel jobs (or array tasks) on the batch system"""
+        return self._control(self.CANCEL_CMD, jobs)
+
+    def requeue(self, jobs):
+        """Requeue jobs (or array tasks) on the batch system"""
+        return self._control(self.REQUEUE_CMD, jobs)
+
+    @timing.timed('parse_script')
+    def parse_script(self, script):
+        with timing.timer('parse_script.read'):
+            job = Job.fromfile(script, self.CMDPRE)
+        self.decode_job(job, os.path.basename(script)[:-6])
         # And parse platform specific output in stderr/out
         if 'array' in job.options:
             path = os.path.dirname(script)
             tasks = []
             for ind in arr2list(job.options['array']):
                 name = job.options['logname'].format(jobid=job.id, ind=ind)
-                task = copy.copy(job)
-                task.ind = ind
-                self.parse_log(os.path.join(path, name+'.err'), task)
+                task = Task(job, ind)
+                task.errfile = os.path.join(path, name+'.err')
+                with timing.timer('parse_log'):
+                    self.parse_log(task.errfile, task)
                 tasks.append(task)
             return tasks
         else:
-            self.parse_log(script, job)
+            job.errfile = script[:-6] + '.err'
+            with timing.timer('parse_log'):
+                self.parse_log(job.errfile, job)
             return job
 
+    def decode_job(self, job, name):
+        """Set the options and id of a job read from the script name.shell"""
+        hdr = [line for line in job.prolog if line.startswith(self.PREFIX)]
+        # Keep any options read from the job body (i.e. parallel)
+        job.options.update(self.decode_options(hdr))
+        # Split log into path and name
+        path, logname = os.path.split(job.options['logname'])
+        job.options['logpath'] = path
+        job.options['logname'] = logname
+
+        rname = fmt2re(logname)
+        m = rname.match(name)
+        if m:
+            job.id = m.group('jobid')
+        else:
+            job.id = name
+
+    def parse_log(self, script, job):
+        """Read the stderr for job (script may be the .shell or .err file)"""
+        if script.endswith('.shell'):
+            stderr = script[:-6] + '.err'
+        else:
+            stderr = script
+        try:
+            with open(stderr) as fh:
+                lines = fh.readlines()
+        except FileNotFoundError:
+            job.done = False
+            job.result = 'LOST'
+            return
+        self.parse_stderr(lines, job)
+
+    def parse_stderr(self, lines, job):
+        """Set the job host, result and stderr from the lines of its stderr"""
+        job.stderr = []
+        job.baterr = []
+        job.steps = []
+        for line in lines:
+            if line.startswith('pyjob:'):
+                self.parse_pyjob(line, job)
+            else:
+                job.stderr.append(line)
+
+        # Last line in stderr should be DONE or FAIL
+        status = lines[-1].strip() if lines else ''
+        if status == 'DONE' or status.startswith('FAIL'):
+            job.done = status == 'DONE'
+            job.result = status
+            job.stderr.pop()
+        else:
+            # Batch script did not complete
+            job.done = False
+            job.result = 'UNKNOWN'
+
+        # Job has completed but wrote to stderr
+        if job.done and job.stderr:
+            job.result = 'ERROR'
+
+    def parse_pyjob(self, line, job):
+        """Read a pyjob: message (host or task runner status) from stderr"""
+        m = _rstep.match(line)
+        if m:
+            job.steps.append((int(m[1]), int(m[2]), float(m[3])))
+        elif line.startswith('pyjob: host:'):
+            host = line.partition('host:')[2].split()
+            job.host = host[0] if host else ''
+
+    def status(self, jobs):
+        """Return a dict mapping jobid to the batch system state (e.g. PENDING,
+        RUNNING) for any jobs still known to the batch system, or None if the
+        batch system cannot report job states."""
+        return None
+
 
 class NoBatchSystem(BatchSystemBase):
     """Dummy class for when we don't have a batch system"""
@@ -183,9 +428,20 @@ class NoBatchSystem(BatchSystemBase):
     PREFIX = '#BATCH'
     ENVVAR = {}
 
-    def submit(self, job, dryrun=False):
+    def submit(self, job, dryrun=False, skip_completed=None):
+        job = self.prepare(job, skip_completed)
+        if job is None:
+            return
         script = self.write_script(job)
         print(script)
 
     def encode_options(self, options):
-        return [f'{self.PREFIX} {i[0]} {i[1]}' for i in options.items()]
+        return [f'{self.PREFIX} {k} {arr2str(v) if k == "array" else v}'
+                for k, v in options.items()]
+
+    def decode_options(self, hdr):
+        opts = {}
+        for line in hdr:
+            key, _, value = line[len(self.PREFIX)+1:].partition(' ')
+            opts[key] = str2arr(value) if key == 'array' else value
+        return opts
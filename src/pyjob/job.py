@@ -1,23 +1,33 @@
+import copy
+import hashlib
 import logging
 
 _log = logging.getLogger(__name__)
 
+RUNNER_EOF = 'PYJOB_TASKS'
+
 
 def split(s):
     """Split input into a list of lines"""
     return s.splitlines() if isinstance(s, str) else s
 
 
-class Job():
+class Job:
     """Base class for cluster jobs
 
     Jobs comprise two parts: shell script for job setup and running simple programs,
     and a series of tasks (i.e. the main program to run). This split is done so we
     can add appropriate cluster commands to the main tasks - e.g. srun - if they are
     necessary to pass signals / or the cluster to collect apprioriate error codes.
+
+    Jobs read from file only split the script into the prolog, body and epilog. The
+    body is parsed into the script and command the first time either is accessed.
     """
+    __slots__ = ('_command', '_script', '_body', '_prefix', 'options', 'env',
+                 'prolog', 'epilog', 'id', 'stdoutname', 'errfile', 'host', 'done',
+                 'result', 'stderr', 'baterr', 'steps')
 
-    def __init__(self, cmd, script=[], options={}, env=None):
+    def __init__(self, cmd, script=[], options=None, env=None):
         """Create a new pyjob.Job instance.
 
         Parameters:
@@ -32,17 +42,107 @@ class Job():
         env: str, optional
             The shell environment e.g. bash
         """
-        self.command = split(cmd)
-        self.script = split(script)
-        self.options = options
+        self._command = split(cmd)
+        self._script = split(script)
+        self._body = None
+        self._prefix = None
+        self.options = {} if options is None else options
         self.env = env
+        self.prolog = []
+        self.epilog = []
+        # Set when the job is submitted or read from a log directory
+        self.id = None
+        self.stdoutname = None
+        self.errfile = None
+        # Set by the batch system when parsing the job stderr
+        self.host = ''
+        self.done = False
+        self.result = None
+        self.stderr = []
+        self.baterr = []
+        self.steps = []     # (command number, status, seconds) from pyjob.runner
+
+    def _parse(self):
+        """Split the job body into script setup and commands"""
+        lines, prefix = self._body, self._prefix
+        self._body = None
+        i1, i2 = 0, len(lines)
+        while i1 < i2 and not lines[i1]:
+            i1 += 1
+        while i2 > i1 and not lines[i2-1]:
+            i2 -= 1
+        command = lines[i1:i2]
+        script = []
+        runner = [line.endswith(f"<<'{RUNNER_EOF}'") for line in command]
+        if True in runner and RUNNER_EOF in command:
+            # Commands are passed to the task runner in a here document
+            i1 = runner.index(True)
+            i2 = command.index(RUNNER_EOF, i1)
+            script = command[:i1]
+            command = command[i1+1:i2]
+        elif prefix:
+            pre = [line.startswith(prefix) for line in command]
+            try:
+                i1 = pre.index(True)
+                script = command[:i1]
+                command = command[i1:]
+                i1 = len(prefix)
+                command = [line[i1:].strip() if line.startswith(prefix) else line for line in command]
+            except ValueError:
+                # Existing script did not use prefix, so assume last line was command
+                script = command[:-1]
+                command = command[-1:]
+        self._command = command
+        self._script = script
+
+    @property
+    def command(self):
+        if self._body is not None:
+            self._parse()
+        return self._command
+
+    @command.setter
+    def command(self, cmd):
+        if self._body is not None:
+            self._parse()
+        self._command = split(cmd)
+
+    @property
+    def script(self):
+        if self._body is not None:
+            self._parse()
+        return self._script
+
+    @script.setter
+    def script(self, script):
+        if self._body is not None:
+            self._parse()
+        self._script = split(script)
+
+    def clone(self, **options):
+        """Return a copy of the job with updated options.
+
+        The options dict is copied so the clone can be modified and submitted
+        without changing this job. The command and script are shared."""
+        job = copy.copy(self)
+        job.options = dict(self.options, **options)
+        return job
+
+    def write(self, prefix=None, prolog=[], epilog=[], runner=None):
+        """Return the job script.
 
-    def write(self, prefix=None, prolog=[], epilog=[]):
+        If runner is given the commands are passed to it on file descriptor 3
+        (see pyjob.runner) rather than run one after another."""
         scr = [self.shebang]
         scr += split(prolog)
         scr += ['#PYJOB script', '']
         scr += self.script
-        if prefix:
+        if runner:
+            runner += f" 3<<'{RUNNER_EOF}'"
+            scr += [prefix + ' ' + runner if prefix else runner]
+            scr += self.command
+            scr += [RUNNER_EOF]
+        elif prefix:
             scr += (prefix + ' ' + c for c in self.command)
         else:
             scr += self.command
@@ -50,16 +150,27 @@ class Job():
         scr += split(epilog)
         return '\n'.join(scr)
 
+    def digest(self, ind=None):
+        """Return a hash identifying the work done by this job (or array task ind).
+
+        Only the environment, script setup and commands are hashed, ignoring
+        whitespace and blank lines, so the same job read back with fromfile gives
+        the same digest. Resource options are deliberately excluded as they are
+        routinely changed when resubmitting and do not change the job output.
+        """
+        lines = [self.shebang] + self.script + self.command
+        body = '\n'.join(line.strip() for line in lines if line.strip())
+        if ind is not None:
+            body += f'\n#PYJOB index {ind}'
+        return hashlib.sha1(body.encode()).hexdigest()
+
     def __str__(self):
         opts = ('#opt {}={}'.format(k, v) for k, v in self.options.items())
         return self.write(prolog=opts)
 
     @property
     def jobid(self):
-        if hasattr(self, 'ind'):
-            return f'{self.id}-{self.ind}'
-        else:
-            return getattr(self, 'id', 'job')
+        return 'job' if self.id is None else self.id
 
     @property
     def shebang(self):
@@ -105,7 +216,7 @@ class Job():
         """
         lines = split(string)
         # Extract the shebang
-        env = lines.pop(0)
+        env = lines[0]
         if env == '#!/bin/sh':
             env = None
         elif env.startswith('#!/usr/bin/env'):
@@ -116,32 +227,75 @@ class Job():
         try:
             i1 = lines.index('#PYJOB script')
             i2 = lines.index('#PYJOB end')
-            prolog = lines[:i1]
+            prolog = lines[1:i1]
             epilog = lines[i2+1:]
-            while not lines[i1+1]:
-                i1 += 1
-            while not lines[i2-1]:
-                i2 -= 1
-            command = lines[i1+1:i2]
+            body = lines[i1+1:i2]
         except ValueError:
             prolog = []
             epilog = []
-            command = lines
-        if prefix:
-            pre = [line.startswith(prefix) for line in command]
-            try:
-                i1 = pre.index(True)
-                script = command[:i1]
-                command = command[i1:]
-                i1 = len(prefix)
-                command = [line[i1:].strip() if line.startswith(prefix) else line for line in command]
-            except ValueError:
-                # Existing script did not use prefix, so assume last line was command
-                script = command[:-1]
-                command = command[-1]
-        else:
-            script = []
-        job = cls(command, script, env=env)
+            body = lines[1:]
+        job = cls([], env=env)
+        # Restore the parallel option from the task runner line
+        for line in body:
+            if line.endswith(f"<<'{RUNNER_EOF}'"):
+                args = line.split()
+                job.options['parallel'] = args[args.index('-j')+1] if '-j' in args else 'all'
+                break
+        job._body = body
+        job._prefix = prefix
         job.prolog = prolog
         job.epilog = epilog
         return job
+
+
+def _parent(name):
+    return property(lambda self: getattr(self.job, name),
+                    doc=f'The {name} of the parent job')
+
+
+class Task:
+    """A single task of an array job
+
+    Tasks are lightweight views of their parent job which only store the array
+    index and the result of running that index. Everything else is read from the
+    shared parent job so must be changed there (or via clone).
+    """
+    __slots__ = ('job', 'ind', 'errfile', 'host', 'done', 'result', 'stderr', 'baterr',
+                 'steps')
+
+    command = _parent('command')
+    script = _parent('script')
+    options = _parent('options')
+    env = _parent('env')
+    prolog = _parent('prolog')
+    epilog = _parent('epilog')
+    id = _parent('id')
+    shebang = _parent('shebang')
+
+    def __init__(self, job, ind):
+        self.job = job
+        self.ind = ind
+        self.errfile = None
+        self.host = ''
+        self.done = False
+        self.result = None
+        self.stderr = []
+        self.baterr = []
+        self.steps = []
+
+    def clone(self, **options):
+        """Return a new job which only runs this task"""
+        return self.job.clone(**dict(options, array=self.ind))
+
+    def write(self, prefix=None, prolog=[], epilog=[], runner=None):
+        return self.job.write(prefix, prolog, epilog, runner)
+
+    def digest(self):
+        return self.job.digest(self.ind)
+
+    def __str__(self):
+        return str(self.job)
+
+    @property
+    def jobid(self):
+        return f'{self.job.jobid}-{self.ind}'
@@ -0,0 +1,118 @@
+"""
+In-job task runner
+
+Runs the commands of a job in parallel inside its allocation, rather than one
+after another. Enable it with the "parallel" job option, giving the number of
+commands to run at once (or "all" to use every core allocated to the job):
+
+    pyjob.Job(['./process a', './process b', './process c'],
+              options={'parallel': 'all'})
+
+The job script then passes its commands to
+
+    python -m pyjob.runner [-j N] [-s SHELL] [-f FILE]
+
+which starts each command in its own process group, forwards INT, TERM, USR1
+and USR2 to all running commands, and writes a line for each finished command
+to stderr which is read back by parse_log:
+
+    pyjob: task 2 status 0 time 12.31
+
+The runner exits with the status of the first (in command order) command
+which failed, or 0 if they all succeeded.
+
+Each command runs in a new shell, not the job script's shell, so only exported
+variables (and with bash exported functions) are visible to it. Job scripts
+using the runner enable "set -a" before the script section for this reason.
+"""
+import argparse
+import collections
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+FORWARD = (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2)
+
+
+def ncores():
+    """Return the number of cores available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def exitcode(wstatus):
+    """Convert a wait status to a shell style exit code"""
+    if os.WIFSIGNALED(wstatus):
+        return 128 + os.WTERMSIG(wstatus)
+    return os.WEXITSTATUS(wstatus)
+
+
+def run(commands, nproc=None, shell=None, stream=sys.stderr):
+    """Run commands with up to nproc at once, returning the exit status"""
+    nproc = nproc or ncores()
+    todo = collections.deque(enumerate(commands))
+    running = {}    # pid -> (task number, start time)
+    status = {}
+    stopped = None
+
+    def forward(signum, frame):
+        nonlocal stopped
+        stopped = signum
+        for pid in running:
+            try:
+                os.killpg(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    handlers = {s: signal.signal(s, forward) for s in FORWARD}
+    try:
+        while running or (todo and stopped is None):
+            while todo and stopped is None and len(running) < nproc:
+                i, cmd = todo.popleft()
+                proc = subprocess.Popen(cmd, shell=True, executable=shell,
+                                        start_new_session=True)
+                # Reaped below with os.wait so Popen must not wait on it too
+                proc.returncode = 0
+                running[proc.pid] = (i, time.monotonic())
+            pid, wstatus = os.wait()
+            if pid not in running:
+                continue
+            i, t0 = running.pop(pid)
+            status[i] = exitcode(wstatus)
+            print(f'pyjob: task {i} status {status[i]} time {time.monotonic() - t0:.2f}',
+                  file=stream, flush=True)
+    finally:
+        for s, handler in handlers.items():
+            signal.signal(s, handler)
+    failed = [status[i] for i in sorted(status) if status[i]]
+    if failed:
+        return failed[0]
+    return 128 + stopped if stopped else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyjob.runner',
+                                     description='Run job commands in parallel')
+    parser.add_argument('-j', dest='nproc', type=int,
+                        help='Number of commands to run at once (default all cores)')
+    parser.add_argument('-s', dest='shell', help='Shell used to run each command')
+    parser.add_argument('-f', dest='file', default='-',
+                        help='File listing one command per line (default stdin)')
+    args = parser.parse_args(argv)
+    if args.file == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.file) as fh:
+            lines = fh.read().splitlines()
+    commands = [line for line in lines if line.strip()]
+    shell = args.shell and (shutil.which(args.shell) or args.shell)
+    return run(commands, args.nproc, shell)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
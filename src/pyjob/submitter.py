@@ -0,0 +1,201 @@
+"""
+Submitting many jobs without overloading the batch system
+
+SubmitQueue submits jobs concurrently while adapting to how the scheduler is
+coping. The number of submissions in flight grows by one per window while the
+submit command responds within target_latency and is halved when it is slow or
+fails with a transient error (AIMD). When the per-user submission limit is
+reached submission pauses, with the pause doubling up to max_pause, until jobs
+have drained enough for the scheduler to accept more.
+
+Each successful submission is appended to an optional journal file so a driver
+which is interrupted can be rerun and will skip the jobs already submitted:
+
+    queue = SubmitQueue(journal='logs/submit.journal')
+    for job in jobs:
+        queue.add(job)
+    jobids = queue.run()
+
+Jobs are identified in the journal by their Job.digest() and array indices
+unless a key is given (see jobkey). Jobs differing only in other options must
+be given their own keys. Submissions still in flight when the run stops (e.g.
+on Ctrl-C) are waited for and journalled, so a job is only submitted twice if
+the driver is killed outright between the batch system accepting the job and
+the journal being written.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import time
+
+import pyjob
+from pyjob import timing
+from pyjob.core import SubmitError, arr2list, arr2str, list2arr, str2arr
+
+_log = logging.getLogger(__name__)
+
+
+def jobkey(job):
+    """Return the default journal key for job: its digest plus a hash of the
+    array indices, so chunks of the same array job get different keys"""
+    key = job.digest()
+    if 'array' in job.options:
+        arrdef = job.options['array']
+        if isinstance(arrdef, str):
+            arrdef = str2arr(arrdef)
+        indices = arr2str(list2arr(arr2list(arrdef)))
+        key += '-' + hashlib.sha1(indices.encode()).hexdigest()[:16]
+    return key
+
+
+class SubmitQueue:
+    """Queue of jobs to submit with adaptive concurrency"""
+
+    def __init__(self, cluster=None, journal=None, max_workers=16, target_latency=5.0,
+                 pause=60, max_pause=900, retries=5):
+        """Create a new submission queue.
+
+        Parameters:
+        -----------
+        cluster : BatchSystemBase, optional
+            Batch system to submit to (default pyjob.cluster)
+        journal : str, optional
+            File recording submitted jobs, used to resume an interrupted run
+        max_workers : int, optional
+            Maximum number of concurrent submissions
+        target_latency : float, optional
+            Submissions slower than this (seconds) reduce the concurrency
+        pause, max_pause : float, optional
+            Initial and maximum pause (seconds) when the submit limit is reached
+        retries : int, optional
+            Number of times to retry a submission after a transient error
+        """
+        self.cluster = cluster
+        self.journal = journal
+        self.max_workers = max_workers
+        self.target_latency = target_latency
+        self.pause = pause
+        self.max_pause = max_pause
+        self.retries = retries
+        self.jobs = []
+        self.keys = set()
+        self.failed = {}
+        self.submitted = self.read_journal()
+
+    def read_journal(self):
+        """Return a dict of key -> jobid for jobs recorded in the journal"""
+        submitted = {}
+        if self.journal and os.path.exists(self.journal):
+            with open(self.journal) as fh:
+                for line in fh:
+                    key, _, jobid = line.strip().partition(' ')
+                    if key:
+                        submitted[key] = jobid or None
+        return submitted
+
+    def add(self, job, key=None):
+        """Add a job to the queue.
+
+        Raises ValueError if a job with the same key is already queued, as only
+        one of them would be recorded in the journal."""
+        key = key or jobkey(job)
+        if key in self.keys:
+            raise ValueError(f'Job with key {key} already queued, pass a unique key')
+        self.keys.add(key)
+        self.jobs.append((key, job))
+
+    def run(self, skip_completed=None):
+        """Submit all queued jobs returning a dict of key -> jobid.
+
+        Jobs already in the journal are not resubmitted. Jobs which could not be
+        submitted are left in the failed dict (key -> SubmitError, or any other
+        exception raised while submitting) and do not stop the others."""
+        cluster = self.cluster or pyjob.cluster
+        results = {}
+        todo = collections.deque()
+        for key, job in self.jobs:
+            if key in self.submitted:
+                results[key] = self.submitted[key]
+            else:
+                todo.append((key, job, 0))
+        self.jobs = []
+        self.keys = set()
+
+        def submit(job):
+            t0 = time.perf_counter()
+            jobid = cluster.submit(job, skip_completed=skip_completed)
+            return jobid, time.perf_counter() - t0
+
+        window = 1.0
+        pause = self.pause
+        resume = 0          # Time when submission can restart after a pause
+        decreased = 0       # Time of the last decrease, so we only halve once per interval
+        inflight = {}
+        journal = open(self.journal, 'a') if self.journal else None
+
+        def record(key, jobid):
+            results[key] = self.submitted[key] = jobid
+            if journal:
+                journal.write(f'{key} {jobid or ""}\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+                while todo or inflight:
+                    now = time.monotonic()
+                    while todo and len(inflight) < int(window) and now >= resume:
+                        key, job, attempt = todo.popleft()
+                        inflight[pool.submit(submit, job)] = (key, job, attempt)
+                    if not inflight:
+                        time.sleep(max(0, resume - now))
+                        continue
+                    finished, _ = concurrent.futures.wait(
+                        inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    now = time.monotonic()
+                    for future in finished:
+                        key, job, attempt = inflight.pop(future)
+                        try:
+                            jobid, latency = future.result()
+                        except SubmitError as err:
+                            if err.reason == 'limit':
+                                timing.count('submit.limit')
+                                todo.appendleft((key, job, attempt))
+                                window = 1.0
+                                if now >= resume:
+                                    _log.info('Submit limit reached, pausing for %ds', pause)
+                                    resume = now + pause
+                                    pause = min(2 * pause, self.max_pause)
+                            elif err.reason == 'retry' and attempt < self.retries:
+                                timing.count('submit.retry')
+                                todo.appendleft((key, job, attempt + 1))
+                                window = max(1.0, window / 2)
+                                decreased = now
+                                resume = max(resume, now + 2 ** attempt)
+                            else:
+                                _log.warning('Failed to submit %s: %s', key, err)
+                                self.failed[key] = err
+                            continue
+                        except Exception as err:
+                            _log.warning('Failed to submit %s: %s', key, err)
+                            self.failed[key] = err
+                            continue
+                        record(key, jobid)
+                        pause = self.pause
+                        if latency > self.target_latency:
+                            if now - decreased > self.target_latency:
+                                window = max(1.0, window / 2)
+                                decreased = now
+                        else:
+                            window = min(self.max_workers, window + 1 / window)
+        finally:
+            # The pool has waited for any submissions still in flight when we
+            # stopped early, record those the batch system accepted
+            for future, (key, job, attempt) in inflight.items():
+                if not future.cancelled() and future.exception() is None:
+                    record(key, future.result()[0])
+            if journal:
+                journal.close()
+        return results
@@ -0,0 +1,140 @@
+"""
+Timing instrumentation for pyjob
+
+Timers and counters are disabled by default, when they only cost a flag check.
+Once enabled every timed call is recorded and passed to any registered hooks,
+e.g. to forward timings to a monitoring system:
+
+    import pyjob.timing
+    pyjob.timing.enable()
+    pyjob.timing.add_hook(lambda name, seconds: print(name, seconds))
+
+A summary of call counts and p50 / p95 latencies is available from report()
+and is written at exit when enabled with a report file (or from the pyjob shell
+with --profile or --profile-file).
+"""
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import math
+import sys
+import time
+
+enabled = False
+_times = collections.defaultdict(list)
+_counts = collections.Counter()
+_hooks = []
+
+
+def enable(report=None):
+    """Start recording timings.
+
+    If report is given then a summary is written at exit: '-' writes a table to
+    stderr, otherwise report is the name of a JSON file."""
+    global enabled
+    enabled = True
+    if report:
+        atexit.register(write_report, None if report == '-' else report)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Discard all recorded timings and counts"""
+    _times.clear()
+    _counts.clear()
+
+
+def add_hook(func):
+    """Register func(name, seconds) to be called after every timed call"""
+    _hooks.append(func)
+
+
+def remove_hook(func):
+    _hooks.remove(func)
+
+
+def count(name, n=1):
+    """Increment the counter name"""
+    if enabled:
+        _counts[name] += n
+
+
+def record(name, seconds):
+    """Record a single timing for name"""
+    _times[name].append(seconds)
+    for hook in _hooks:
+        hook(name, seconds)
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Context manager timing the enclosed block"""
+    if not enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+def timed(name):
+    """Decorator timing every call to the decorated function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+def percentile(values, p):
+    """Return the p'th percentile of sorted values (nearest rank)"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def report():
+    """Return a dict of statistics for each timer and counter"""
+    stats = {}
+    for name, times in _times.items():
+        times = sorted(times)
+        stats[name] = {'calls': len(times),
+                       'total': sum(times),
+                       'p50': percentile(times, 50),
+                       'p95': percentile(times, 95)}
+    for name, n in _counts.items():
+        stats.setdefault(name, {})['count'] = n
+    return stats
+
+
+def write_report(filename=None):
+    """Write report() as JSON to filename, or as a table to stderr"""
+    stats = report()
+    if filename:
+        with open(filename, 'w') as fh:
+            json.dump(stats, fh, indent=2, sort_keys=True)
+        return
+    print(f"{'timer':24s} {'calls':>8s} {'total':>10s} {'p50':>10s} {'p95':>10s}",
+          file=sys.stderr)
+    for name in sorted(stats):
+        s = stats[name]
+        if 'calls' in s:
+            print(f"{name:24s} {s['calls']:8d} {s['total']:10.4f} {s['p50']:10.4f} "
+                  f"{s['p95']:10.4f}", file=sys.stderr)
+        if 'count' in s:
+            print(f"{name:24s} {s['count']:8d}", file=sys.stderr)
@@ -0,0 +1,210 @@
+"""
+Tests for the LSF backend using fake bsub / bjobs / bkill commands on PATH
+"""
+import os
+import stat
+
+import pytest
+
+from pyjob.backend import lsf
+from pyjob.core import SubmitError
+from pyjob.job import Job, Task
+
+REPORT = """Sender: LSF System <lsfadmin@host1>
+Subject: Job 1234: <myjob> in cluster <cluster> Exited
+
+Job <myjob> was submitted from host <login1> by user <user>.
+{term}
+Exited with exit code 137.
+
+Resource usage summary:
+
+    CPU time :                                   1.00 sec.
+
+"""
+FOLLOWS = "The output (if any) follows:\n\n"
+ABOVE = "The output (if any) is above this job summary.\n"
+
+
+@pytest.fixture
+def cluster():
+    return lsf.BatchSystem()
+
+
+@pytest.fixture
+def fakebin(tmp_path, monkeypatch):
+    """Directory on PATH for fake LSF commands, returning a function to add a
+    command which records its arguments in <name>.args and prints output"""
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    monkeypatch.setenv('PATH', f"{bindir}{os.pathsep}{os.environ['PATH']}")
+
+    def add(name, stdout='', stderr='', status=0):
+        script = bindir / name
+        script.write_text(f"""#!/bin/sh
+echo "$@" >> {bindir / name}.args
+cat > /dev/null
+printf '%s' '{stdout}'
+printf '%s' '{stderr}' >&2
+exit {status}
+""")
+        script.chmod(script.stat().st_mode | stat.S_IEXEC)
+        return bindir / (name + '.args')
+    return add
+
+
+def test_options_roundtrip(cluster):
+    options = {'name': 'myjob',
+               'array': [range(1, 11), 20],
+               'queue': 'short',
+               'account': 'myproject',
+               'runtime': '01:00',
+               'logname': '{jobid}-{ind}',
+               'memlimit': '4000',
+               'tmplimit': '100',
+               'exclude': 'host1 host2'}
+    hdr = cluster.encode_options(options)
+    assert '#BSUB -J myjob[1-10,20]' in hdr
+    assert '#BSUB -P myproject' in hdr
+    assert '#BSUB -R "select[hname!=host1 && hname!=host2]"' in hdr
+    assert cluster.decode_options(hdr) == options
+
+
+def test_options_roundtrip_no_array(cluster):
+    options = {'name': 'myjob', 'logname': 'myjob-{jobid}'}
+    hdr = cluster.encode_options(options)
+    assert hdr[0] == '#BSUB -J myjob'
+    assert cluster.decode_options(hdr) == options
+
+
+def write_logs(path, out=None, err=None):
+    if out is not None:
+        (path / 'job.out').write_text(out)
+    if err is not None:
+        (path / 'job.err').write_text(err)
+    return str(path / 'job.err')
+
+
+@pytest.mark.parametrize('term, result', sorted(lsf.term2map.items())
+                         + [('TERM_SOMETHING_NEW', 'BATCHERR')])
+@pytest.mark.parametrize('layout', ['start', 'appended'])
+def test_parse_log_term(cluster, tmp_path, term, result, layout):
+    report = REPORT.format(term=f'{term}: job killed.')
+    if layout == 'start':
+        out = report + FOLLOWS + 'job output\n' * 100
+    else:
+        out = 'job output\n' * 100 + '\n' + '-' * 60 + '\n\n' + report + ABOVE
+    errfile = write_logs(tmp_path, out, 'pyjob: host: node1\nworking\n')
+    job = Job([])
+    cluster.parse_log(errfile, job)
+    assert job.done is False
+    assert job.result == result
+    assert job.host == 'node1'
+    assert job.stderr == ['working\n']
+    assert job.baterr == [f'{term}: job killed.\n', 'Exited with exit code 137.\n']
+
+
+def test_parse_log_appended_large_output(cluster, tmp_path):
+    # Only the tail of the file is read, including part of the job output
+    out = ('x' * 200 + '\n') * 1000 + 'TERM_OWNER: printed by the job\n' \
+        + REPORT.format(term='TERM_MEMLIMIT: job killed.') + ABOVE
+    errfile = write_logs(tmp_path, out, 'pyjob: host: node1\n')
+    job = Job([])
+    cluster.parse_log(errfile, job)
+    assert job.result == 'OOMEMORY'
+
+
+def test_parse_log_output_after_report(cluster, tmp_path):
+    # Job output following a leading report is not part of the report
+    out = REPORT.format(term='') + FOLLOWS + 'TERM_RUNLIMIT: printed by the job\n'
+    errfile = write_logs(tmp_path, out, 'pyjob: host: node1\n')
+    job = Job([])
+    cluster.parse_log(errfile, job)
+    assert job.result == 'ERROR'
+    assert job.baterr == ['Exited with exit code 137.\n']
+
+
+def test_parse_log_done(cluster, tmp_path):
+    errfile = write_logs(tmp_path, 'Sender: LSF System\n\nSuccessfully completed.\n' + FOLLOWS,
+                         'pyjob: host: node1\nDONE\n')
+    job = Job([])
+    cluster.parse_log(errfile, job)
+    assert job.done is True
+    assert job.result == 'DONE'
+
+
+def test_parse_log_report_only(cluster, tmp_path):
+    # Killed before the job started writing to stderr
+    errfile = write_logs(tmp_path, REPORT.format(term='TERM_RUNLIMIT: job killed.') + FOLLOWS)
+    job = Job([])
+    cluster.parse_log(errfile, job)
+    assert job.result == 'TIMEOUT'
+
+
+def test_parse_log_lost(cluster, tmp_path):
+    job = Job([])
+    cluster.parse_log(str(tmp_path / 'job.err'), job)
+    assert job.result == 'LOST'
+
+
+def test_status(cluster, fakebin):
+    args = fakebin('bjobs', stdout='1234 0 RUN\n1235 3 PEND\n1235 4 EXIT\n1235 5 USUSP\n'
+                                   '1236 0 DONE\nJob <9> is not found\n')
+    jobs = [Job([]) for _ in range(3)]
+    for job, jid in zip(jobs, ['1235', '1234', '1235']):
+        job.id = jid
+    states = cluster.status(jobs + [Job([])])
+    assert states == {'1234': 'RUNNING',
+                      '1235-3': 'PENDING',
+                      '1235-4': 'FAILED',
+                      '1235-5': 'SUSPENDED',
+                      '1236': 'COMPLETED'}
+    assert args.read_text() == '-a -noheader -o jobid jobindex stat 1234 1235\n'
+
+
+def test_status_no_jobs(cluster, fakebin):
+    args = fakebin('bjobs')
+    assert cluster.status([Job([])]) == {}
+    assert not args.exists()
+
+
+def test_cancel(cluster, fakebin):
+    args = fakebin('bkill')
+    single = Job([])
+    single.id = '1234'
+    array = Job([])
+    array.id = '1235'
+    tasks = [Task(array, ind) for ind in (1, 2, 3, 5, 10)]
+    assert cluster.cancel([single] + tasks) == 0
+    assert args.read_text() == '1234 1235[1-3,5,10]\n'
+
+
+def test_cancel_failed(cluster, fakebin):
+    fakebin('bkill', stderr='Job has already finished', status=255)
+    job = Job([])
+    job.id = '1234'
+    assert cluster.cancel([job]) == 1
+
+
+def test_submit(cluster, fakebin, tmp_path):
+    args = fakebin('bsub', stdout='Job <4321> is submitted to default queue <normal>.\n')
+    job = Job(['./run'], options={'logpath': str(tmp_path / 'logs')})
+    assert cluster.submit(job) == '4321'
+    assert args.exists()
+    script = tmp_path / 'logs' / '4321.shell'
+    parsed = cluster.parse_script(str(script))
+    assert parsed.id == '4321'
+    assert parsed.command == ['./run']
+    assert parsed.result == 'LOST'
+
+
+@pytest.mark.parametrize('stderr, reason', [
+    ('User <user>: Pending job threshold reached. Retrying in 60 seconds...', 'limit'),
+    ('LSF is down. Please wait ...', 'retry'),
+    ('Bad resource requirement syntax', None)])
+def test_submit_error(cluster, fakebin, tmp_path, stderr, reason):
+    fakebin('bsub', stderr=stderr, status=255)
+    job = Job(['./run'], options={'logpath': str(tmp_path)})
+    with pytest.raises(SubmitError) as err:
+        cluster.submit(job)
+    assert err.value.reason == reason